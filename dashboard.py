@@ -6,11 +6,13 @@ Real-time visualization of customer sentiment data using Streamlit
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objects as go
 from datetime import datetime, timedelta, timezone
 import os
 import json
-from firebase_admin import firestore, credentials
+import asyncio
+import threading
+from dataclasses import dataclass
+from firebase_admin import firestore, firestore_async, credentials
 import firebase_admin
 from dotenv import load_dotenv
 from streamlit_autorefresh import st_autorefresh
@@ -45,7 +47,24 @@ def get_firestore_client():
             else:
                 st.error("Firebase credentials not found.")
                 st.stop()
-    return firestore.client()
+    # One AsyncClient per process: every query and count() multiplexes over its single gRPC channel
+    db = firestore_async.client()
+    run_async(open_channel(db))
+    return db
+
+async def open_channel(db):
+    # Build the channel eagerly, on the dashboard's loop, so the first refresh doesn't pay for the handshake
+    return db._firestore_api
+
+@st.cache_resource
+def get_event_loop():
+    # One long-lived loop for all reruns: the AsyncClient's gRPC channel binds to the loop it first runs on
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
 
 # --- Helper: Retrieve App ID ---
 def get_app_id():
@@ -61,53 +80,106 @@ def get_app_id():
     return app_id
 
 # --- Helper: Load Ticket Data ---
-@st.cache_data(ttl=30)
-def load_tickets_data(app_id):
-    try:
-        db = get_firestore_client()
-        tickets_ref = db.collection(f'artifacts/{app_id}/public/data/raw_tickets')
-        docs = tickets_ref.where('status', '==', 'processed').get()
-        tickets_data = []
-        for doc in docs:
-            data = doc.to_dict()
-            # Robust timestamp conversion
-            if 'timestamp' in data and data['timestamp']:
-                ts = data['timestamp']
-                if hasattr(ts, "seconds"):
-                    data['timestamp'] = datetime.fromtimestamp(ts.seconds)
-                else:
-                    data['timestamp'] = pd.to_datetime(ts)
-            else:
-                data['timestamp'] = pd.NaT
-            data['id'] = doc.id
-            tickets_data.append(data)
-        df = pd.DataFrame(tickets_data)
-        # Defensive: fill missing columns so downstream code is robust
-        for col in ['sentiment', 'source', 'sender', 'summary', 'confidence']:
-            if col not in df.columns:
-                df[col] = None
-        return df
-    except Exception as e:
-        st.error(f"Error loading data: {e}")
-        return pd.DataFrame()
+SENTIMENTS = ['anger', 'confusion', 'delight', 'neutral']
+SOURCES = ['Email', 'Form_Contact', 'Form_Feedback', 'Form_Support', 'Form_Custom']
+SENTIMENT_COLORS = pd.Series({'anger': '#ff4444', 'confusion': '#ff8800', 'delight': '#44ff44', 'neutral': '#888888'})
+
+# Sidebar time ranges, in days; the selected one bounds what load_tickets_async fetches
+TIME_RANGE_DAYS = {
+    "Last 24 hours": 1,
+    "Last 3 days": 3,
+    "Last week": 7,
+    "Last month": 30,
+}
+
+# Documents per RPC when paging through large result sets
+PAGE_SIZE = 500
+
+# Fields the renderers read; raw_data and other large fields stay on the server
+TICKET_FIELDS = ['timestamp', 'sentiment', 'source', 'sender', 'summary', 'confidence', 'keywords', 'status', 'message']
+
+async def stream_documents(query, page_size=PAGE_SIZE):
+    """Yield snapshots page by page, resuming each page after the last document seen"""
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        count = 0
+        async for doc in page.limit(page_size).stream():
+            count += 1
+            last_doc = doc
+            yield doc
+        if count < page_size:
+            return
+
+async def load_tickets_async(db, app_id, max_days=30):
+    tickets_ref = db.collection(f'artifacts/{app_id}/public/data/raw_tickets')
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_days)
+    # Served by the (status ASC, timestamp DESC) composite index in firestore.indexes.json
+    query = (
+        tickets_ref.where('status', '==', 'processed')
+        .where('timestamp', '>=', cutoff)
+        .order_by('timestamp', direction=firestore.Query.DESCENDING)
+        .select(TICKET_FIELDS)
+    )
+    tickets_data = []
+    async for doc in stream_documents(query):
+        data = doc.to_dict()
+        data['id'] = doc.id
+        tickets_data.append(data)
+    df = pd.DataFrame(tickets_data)
+    # Robust timestamp conversion, done once over the whole column
+    if 'timestamp' not in df.columns:
+        df['timestamp'] = pd.NaT
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True, errors='coerce')
+    # Defensive: fill missing columns so downstream code is robust
+    for col in ['sentiment', 'source', 'sender', 'summary', 'confidence']:
+        if col not in df.columns:
+            df[col] = None
+    # Fixed categories: isin/value_counts/groupby then work on small integer codes
+    df['sentiment'] = pd.Categorical(df['sentiment'], categories=SENTIMENTS)
+    df['source'] = pd.Categorical(df['source'], categories=SOURCES)
+    return df
 
 # --- Helper: Get System Stats ---
-@st.cache_data(ttl=60)
-def get_system_stats(app_id):
-    try:
-        db = get_firestore_client()
-        tickets_ref = db.collection(f'artifacts/{app_id}/public/data/raw_tickets')
-        docs = tickets_ref.get()
-        stats = dict.fromkeys(['total', 'processed', 'new', 'processing', 'error'], 0)
-        for doc in docs:
-            status = doc.to_dict().get('status', 'unknown')
-            if status in stats:
-                stats[status] += 1
-            stats['total'] += 1
-        return stats
-    except Exception as e:
-        st.error(f"Error loading system stats: {e}")
-        return dict.fromkeys(['total', 'processed', 'new', 'processing', 'error'], 0)
+STATUS_KEYS = ['processed', 'new', 'processing', 'error']
+
+async def count_documents(query):
+    # Server-side aggregation: billed per index entry batch, no documents are downloaded
+    result = await query.count().get()
+    return result[0][0].value
+
+async def get_system_stats_async(db, app_id):
+    tickets_ref = db.collection(f'artifacts/{app_id}/public/data/raw_tickets')
+    counts = await asyncio.gather(*(
+        count_documents(tickets_ref.where('status', '==', status)) for status in STATUS_KEYS
+    ))
+    stats = dict(zip(STATUS_KEYS, counts))
+    # Agents only ever write these statuses, so the total needs no aggregation of its own
+    stats['total'] = sum(counts)
+    return stats
+
+async def fetch_all(db, app_id, max_days=30):
+    return await asyncio.gather(
+        load_tickets_async(db, app_id, max_days),
+        get_system_stats_async(db, app_id),
+        return_exceptions=True
+    )
+
+# --- Helper: Load Dashboard Data ---
+# cache_resource hands back the cached objects themselves instead of unpickling a copy per hit,
+# so callers must treat the returned frame and dict as read-only
+@st.cache_resource(ttl=30)
+def load_dashboard_data(app_id, max_days=30):
+    """Fetch tickets and system stats concurrently; returns (tickets_df, stats)"""
+    db = get_firestore_client()
+    tickets_df, stats = run_async(fetch_all(db, app_id, max_days))
+    if isinstance(tickets_df, Exception):
+        st.error(f"Error loading data: {tickets_df}")
+        tickets_df = pd.DataFrame()
+    if isinstance(stats, Exception):
+        st.error(f"Error loading system stats: {stats}")
+        stats = dict.fromkeys(['total'] + STATUS_KEYS, 0)
+    return tickets_df, stats
 
 # --- Sidebar: Controls ---
 def render_sidebar():
@@ -115,18 +187,18 @@ def render_sidebar():
     st.subheader("🔧 Controls")
     time_range = st.selectbox(
         "Time Range",
-        ["Last 24 hours", "Last 3 days", "Last week", "Last month"],
+        list(TIME_RANGE_DAYS),
         index=2
     )
     sentiment_filter = st.multiselect(
         "Filter by Sentiment",
-        ["anger", "confusion", "delight", "neutral"],
-        default=["anger", "confusion", "delight", "neutral"]
+        SENTIMENTS,
+        default=SENTIMENTS
     )
     source_filter = st.multiselect(
         "Filter by Source",
-        ["Email", "Form_Contact", "Form_Feedback", "Form_Support", "Form_Custom"],
-        default=["Email", "Form_Contact", "Form_Feedback", "Form_Support", "Form_Custom"]
+        SOURCES,
+        default=SOURCES
     )
     return time_range, sentiment_filter, source_filter
 
@@ -136,23 +208,37 @@ def apply_filters(df, time_range, sentiment_filter, source_filter):
         return df
 
     now = datetime.now(timezone.utc)  # this line is key
+    cutoff = now - timedelta(days=TIME_RANGE_DAYS.get(time_range, 30))
 
-    if time_range == "Last 24 hours":
-        cutoff = now - timedelta(hours=24)
-    elif time_range == "Last 3 days":
-        cutoff = now - timedelta(days=3)
-    elif time_range == "Last week":
-        cutoff = now - timedelta(days=7)
-    else:
-        cutoff = now - timedelta(days=30)
-
-    df = df[df['timestamp'] >= cutoff]
-    df = df[df['timestamp'] >= cutoff]
+    # Combine every predicate into one mask so the frame is indexed (and copied) once
+    mask = (df['timestamp'] >= cutoff).values
     if sentiment_filter:
-        df = df[df['sentiment'].isin(sentiment_filter)]
+        mask &= df['sentiment'].isin(sentiment_filter).values
     if source_filter and 'source' in df.columns:
-        df = df[df['source'].isin(source_filter)]
-    return df
+        mask &= df['source'].isin(source_filter).values
+    return df.loc[mask]
+
+# --- Derived Aggregates ---
+@dataclass
+class Aggregates:
+    """Summaries shared by several renderers, computed once per rerun"""
+    sentiment_counts: pd.Series
+    daily_counts: pd.DataFrame
+    recent_mask: object  # numpy bool array over the filtered frame (last 24 hours)
+    recent_anger_df: pd.DataFrame
+
+def compute_aggregates(df):
+    window = datetime.now(timezone.utc) - timedelta(hours=24)
+    recent_mask = (df['timestamp'] >= window).values
+    anger_mask = recent_mask & (df['sentiment'] == 'anger').values
+    dates = df['timestamp'].dt.floor('D').rename('date')
+    return Aggregates(
+        sentiment_counts=df['sentiment'].value_counts(),
+        # Stable column order for plotting, including sentiments absent from the window
+        daily_counts=pd.crosstab(dates, df['sentiment']).reindex(columns=SENTIMENTS, fill_value=0),
+        recent_mask=recent_mask,
+        recent_anger_df=df.loc[anger_mask].sort_values('timestamp', ascending=False)
+    )
 
 # --- Main Rendering Functions ---
 def render_header():
@@ -183,33 +269,31 @@ def render_system_overview(stats):
     col4.metric("Processing", stats['processing'])
     col5.metric("Errors", stats['error'])
 
-def render_sentiment_overview(df):
+def render_sentiment_overview(df, aggregates):
     if df.empty:
         st.warning("No sentiment data available")
         return
     st.subheader("😊 Sentiment Analysis Overview")
-    sentiment_counts = df['sentiment'].value_counts()
+    sentiment_counts = aggregates.sentiment_counts
     col1, col2, col3, col4 = st.columns(4)
-    colors = {'anger': '#ff4444', 'confusion': '#ff8800', 'delight': '#44ff44', 'neutral': '#888888'}
-    for sentiment, col in zip(['anger', 'confusion', 'delight', 'neutral'], [col1, col2, col3, col4]):
+    for sentiment, col in zip(SENTIMENTS, [col1, col2, col3, col4]):
         count = sentiment_counts.get(sentiment, 0)
         pct = (count / len(df) * 100) if len(df) > 0 else 0
         col.metric(sentiment.title(), count, f"{pct:.1f}%")
 
-def render_sentiment_trends(df):
+def render_sentiment_trends(df, aggregates):
     if df.empty:
         return
     st.subheader("📈 Sentiment Trends Over Time")
-    df['date'] = df['timestamp'].dt.date
-    daily = df.groupby(['date', 'sentiment']).size().unstack(fill_value=0)
-    fig = go.Figure()
-    colors = {'anger': '#ff4444', 'confusion': '#ff8800', 'delight': '#44ff44', 'neutral': '#888888'}
-    for sentiment in daily.columns:
-        fig.add_trace(go.Scatter(
-            x=daily.index, y=daily[sentiment],
-            mode='lines+markers', name=sentiment.title(),
-            line=dict(color=colors.get(sentiment, '#888888')), marker=dict(size=6)
-        ))
+    daily = aggregates.daily_counts
+    # Long format lets Plotly build every trace from one frame
+    long_daily = daily.reset_index().melt(id_vars='date', var_name='sentiment', value_name='count')
+    fig = px.line(
+        long_daily, x='date', y='count', color='sentiment',
+        color_discrete_map=SENTIMENT_COLORS.to_dict(), markers=True
+    )
+    fig.update_traces(marker=dict(size=6))
+    fig.for_each_trace(lambda trace: trace.update(name=trace.name.title()))
     fig.update_layout(
         title="Daily Sentiment Counts",
         xaxis_title="Date",
@@ -219,13 +303,17 @@ def render_sentiment_trends(df):
     )
     st.plotly_chart(fig, use_container_width=True)
 
-def render_alerts_section(df):
+def row_value(row, field, default):
+    """Read a scalar field from an itertuples row, substituting default for missing/NaN"""
+    value = getattr(row, field, None)
+    return default if value is None or pd.isna(value) else value
+
+def render_alerts_section(df, aggregates):
     if df.empty:
         return
     st.subheader("🚨 Alerts & High Priority Issues")
-    window = datetime.now(timezone.utc) - timedelta(hours=24)
-    recent_anger = df[(df['sentiment'] == 'anger') & (df['timestamp'] >= window)].sort_values('timestamp', ascending=False)
-    recent_total = len(df[df['timestamp'] >= window])
+    recent_anger = aggregates.recent_anger_df
+    recent_total = int(aggregates.recent_mask.sum())
     anger_ratio = len(recent_anger) / recent_total if recent_total > 0 else 0
     if anger_ratio >= 0.3:
         st.error(f"🚨 **HIGH ANGER ALERT!** {anger_ratio:.1%} of recent messages show anger sentiment")
@@ -235,29 +323,30 @@ def render_alerts_section(df):
         st.success(f"✅ Sentiment levels are stable ({anger_ratio:.1%} anger)")
     if not recent_anger.empty:
         st.markdown("**Recent Angry Messages:**")
-        for _, message in recent_anger.head(5).iterrows():
-            with st.expander(f"From {message.get('sender', 'Unknown')} - {message['timestamp'].strftime('%Y-%m-%d %H:%M')}"):
-                st.write(f"**Source:** {message.get('source', 'Unknown')}")
-                st.write(f"**Summary:** {message.get('summary', 'No summary')}")
-                st.write(f"**Confidence:** {message.get('confidence', 0):.2f}")
-                if isinstance(message.get('keywords'), (list, tuple)):
-                    st.write(f"**Keywords:** {', '.join(message['keywords'])}")
-                st.write(f"**Message:** {message.get('message', '')[:200]}...")
-
-def render_detailed_analysis(df):
+        for row in recent_anger.head(5).itertuples(index=False):
+            with st.expander(f"From {row_value(row, 'sender', 'Unknown')} - {row.timestamp.strftime('%Y-%m-%d %H:%M')}"):
+                st.write(f"**Source:** {row_value(row, 'source', 'Unknown')}")
+                st.write(f"**Summary:** {row_value(row, 'summary', 'No summary')}")
+                st.write(f"**Confidence:** {row_value(row, 'confidence', 0):.2f}")
+                keywords = getattr(row, 'keywords', None)
+                if isinstance(keywords, (list, tuple)):
+                    st.write(f"**Keywords:** {', '.join(keywords)}")
+                st.write(f"**Message:** {row_value(row, 'message', '')[:200]}...")
+
+def render_detailed_analysis(df, aggregates):
     if df.empty:
         return
     st.subheader("🔍 Detailed Analysis")
     col1, col2 = st.columns(2)
     # Pie chart
-    sentiment_counts = df['sentiment'].value_counts()
+    sentiment_counts = aggregates.sentiment_counts
     with col1:
         fig = px.pie(
             values=sentiment_counts.values,
             names=sentiment_counts.index,
             title="Sentiment Distribution",
             color=sentiment_counts.index,
-            color_discrete_map={'anger': '#ff4444', 'confusion': '#ff8800', 'delight': '#44ff44', 'neutral': '#888888'}
+            color_discrete_map=SENTIMENT_COLORS.to_dict()
         )
         st.plotly_chart(fig, use_container_width=True)
     # Bar chart by source
@@ -290,21 +379,22 @@ def main():
     render_header()
     time_range, sentiment_filter, source_filter = render_sidebar()
     with st.spinner("Loading data..."):
-        tickets_df = load_tickets_data(app_id)
-        system_stats = get_system_stats(app_id)
-    # Debug print: see what is actually loaded
-    st.write("Loaded tickets (raw):", tickets_df)
+        tickets_df, system_stats = load_dashboard_data(app_id, TIME_RANGE_DAYS.get(time_range, 30))
+    # Debug view of what is actually loaded; off by default since it ships the frame to the browser
+    if os.getenv('SENTINOVA_DEBUG'):
+        st.expander("Loaded tickets (raw)").dataframe(tickets_df.head(50))
     filtered_df = apply_filters(tickets_df, time_range, sentiment_filter, source_filter)
     render_system_overview(system_stats)
     st.markdown("---")
     if not filtered_df.empty:
-        render_sentiment_overview(filtered_df)
+        aggregates = compute_aggregates(filtered_df)
+        render_sentiment_overview(filtered_df, aggregates)
         st.markdown("---")
-        render_sentiment_trends(filtered_df)
+        render_sentiment_trends(filtered_df, aggregates)
         st.markdown("---")
-        render_alerts_section(filtered_df)
+        render_alerts_section(filtered_df, aggregates)
         st.markdown("---")
-        render_detailed_analysis(filtered_df)
+        render_detailed_analysis(filtered_df, aggregates)
         st.markdown("---")
         render_recent_messages(filtered_df)
     else:
@@ -5,6 +5,7 @@ Monitors email inbox and ingests customer messages into Firebase
 
 import imaplib
 import email
+import email.policy
 import time
 import logging
 from datetime import datetime
@@ -13,18 +14,79 @@ from firebase_admin import credentials
 import firebase_admin
 from email.header import decode_header
 import os
+import re
 from dotenv import load_dotenv
 from retrying import retry
+from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientError
 import json
+from functools import lru_cache
+import random
 
 # Load environment variables
 load_dotenv()
 
+# Firestore rejects batches with more than 500 writes
+FIRESTORE_BATCH_LIMIT = 500
+
+# Pulls the UID out of a FETCH response such as b'3 (UID 42 BODY[] {1234}' or a trailing b' UID 42)'
+FETCH_UID_PATTERN = re.compile(rb'UID (\d+)')
+
+# UIDs per FETCH command; keeps command lines short and bounds memory on a large bootstrap
+FETCH_CHUNK_SIZE = 200
+
+def uid_set(uids):
+    """Compress sorted UIDs into an IMAP sequence set such as b'3:7,9,12:14'"""
+    ranges = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            ranges.append(f'{start}:{prev}' if start != prev else str(start))
+            start = uid
+        prev = uid
+    ranges.append(f'{start}:{prev}' if start != prev else str(start))
+    return ','.join(ranges).encode()
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT = 29 * 60
+
+# Tickets are spread across this many processing shards (see SHARD_ID in processing_agent)
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '1'))
+
+@lru_cache(maxsize=1)
+def _get_db():
+    """Initialize Firebase once per process and return the shared Firestore client"""
+    try:
+        # Check if Firebase app is already initialized
+        firebase_admin.get_app()
+    except ValueError:
+        # Initialize Firebase if not already done
+        cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
+        if os.path.exists(cred_path):
+            cred = credentials.Certificate(cred_path)
+            firebase_admin.initialize_app(cred)
+        else:
+            # Use environment variable for credentials
+            cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
+            if cred_json:
+                cred_dict = json.loads(cred_json)
+                cred = credentials.Certificate(cred_dict)
+                firebase_admin.initialize_app(cred)
+            else:
+                raise ValueError("Firebase credentials not found")
+    return firestore.client()
+
 class EmailIngestionAgent:
     def __init__(self, app_id):
         self.app_id = app_id
         self.setup_logging()
         self.init_firebase()
+        self._pending = []  # (doc_ref, payload) pairs awaiting a batch commit
+
+        # Highest IMAP UID already ingested and the mailbox UIDVALIDITY it belongs to;
+        # None until the first cycle has been recorded
+        self.state_ref = self.db.document(f'artifacts/{self.app_id}/state/email_agent')
+        self.last_uid, self.uidvalidity = self.load_watermark()
 
         # Email configuration
         self.email_server = os.getenv('EMAIL_IMAP_SERVER', 'imap.gmail.com')
@@ -48,26 +110,7 @@ class EmailIngestionAgent:
 
     def init_firebase(self):
         """Initialize Firebase Admin SDK"""
-        try:
-            # Check if Firebase app is already initialized
-            firebase_admin.get_app()
-        except ValueError:
-            # Initialize Firebase if not already done
-            cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
-            if os.path.exists(cred_path):
-                cred = credentials.Certificate(cred_path)
-                firebase_admin.initialize_app(cred)
-            else:
-                # Use environment variable for credentials
-                cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
-                if cred_json:
-                    cred_dict = json.loads(cred_json)
-                    cred = credentials.Certificate(cred_dict)
-                    firebase_admin.initialize_app(cred)
-                else:
-                    raise ValueError("Firebase credentials not found")
-
-        self.db = firestore.client()
+        self.db = _get_db()
         self.logger.info("Firebase initialized successfully")
 
     @retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000)
@@ -98,103 +141,214 @@ class EmailIngestionAgent:
         return str(decoded_header[0])
 
     def extract_email_body(self, msg):
-        """Extract email body from message"""
+        """Extract the text/plain body from message (text/html if there is none), skipping attachments"""
         body = ""
 
-        if msg.is_multipart():
-            for part in msg.walk():
-                ctype = part.get_content_type()
-                cdispo = str(part.get('Content-Disposition'))
-
-                if ctype == 'text/plain' and 'attachment' not in cdispo:
-                    try:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            body = payload.decode('utf-8', errors='ignore')
-                            break
-                    except Exception as e:
-                        self.logger.warning(f"Failed to decode email part: {e}")
-        else:
-            try:
-                payload = msg.get_payload(decode=True)
-                if payload:
-                    body = payload.decode('utf-8', errors='ignore')
-            except Exception as e:
-                self.logger.warning(f"Failed to decode email body: {e}")
+        try:
+            part = msg.get_body(preferencelist=('plain', 'html'))
+            if part is not None:
+                try:
+                    body = part.get_content()
+                except (LookupError, UnicodeDecodeError):
+                    # Unknown or wrong charset declared; fall back to lenient UTF-8
+                    payload = part.get_payload(decode=True)
+                    if payload:
+                        body = payload.decode('utf-8', errors='ignore')
+        except Exception as e:
+            self.logger.warning(f"Failed to decode email body: {e}")
 
         return body.strip()
 
+    def iter_fetched_messages(self, msg_data):
+        """Yield (uid, raw bytes) for each message literal in a UID FETCH response; uid is None if the server omitted it"""
+        # imaplib returns each message as an (envelope, literal) tuple followed by the bytes closing it.
+        # Servers may order FETCH items freely, so the UID can sit in either the envelope or the closing bytes.
+        current = None
+        for part in msg_data:
+            if isinstance(part, tuple):
+                if current:
+                    yield current
+                match = FETCH_UID_PATTERN.search(part[0])
+                current = (int(match.group(1)) if match else None, part[1])
+            elif current and isinstance(part, bytes):
+                uid = current[0]
+                if uid is None:
+                    match = FETCH_UID_PATTERN.search(part)
+                    uid = int(match.group(1)) if match else None
+                yield uid, current[1]
+                current = None
+        if current:
+            yield current
+
+    def parse_email(self, uid, raw_email):
+        """Parse one fetched message into email data, or None to skip it"""
+        try:
+            msg = email.message_from_bytes(raw_email, policy=email.policy.default)
+
+            # Extract email data
+            email_data = {
+                'uid': uid,
+                'sender': self.parse_email_header(msg['From']),
+                'subject': self.parse_email_header(msg['Subject']),
+                'date': self.parse_email_header(msg['Date']),
+                'message_id': self.parse_email_header(msg['Message-ID']),
+                'body': self.extract_email_body(msg)
+            }
+
+            # Skip emails with empty bodies
+            if not email_data['body'].strip():
+                self.logger.warning(f"Skipping email with empty body from {email_data['sender']}")
+                return None
+
+            return email_data
+
+        except Exception as e:
+            self.logger.error(f"Failed to process email UID {uid}: {e}")
+            return None
+
     def store_email_in_firebase(self, email_data):
-        """Store email data in Firestore"""
+        """Queue email data for the next batched Firestore commit"""
         try:
-            doc_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').add({
+            # The ID is derived from the message's IMAP identity, so a refetched message overwrites its ticket
+            doc_id = f"email_{self.uidvalidity}_{email_data['uid']}"
+            doc_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').document(doc_id)
+            self._pending.append((doc_ref, {
                 'source': 'Email',
                 'timestamp': firestore.SERVER_TIMESTAMP,
                 'message': email_data['body'],
                 'subject': email_data['subject'],
                 'sender': email_data['sender'],
                 'status': 'new',
+                'shard': random.randrange(NUM_SHARDS),
                 'raw_data': {
                     'date': email_data['date'],
                     'message_id': email_data['message_id']
                 }
-            })
+            }))
 
-            self.logger.info(f"Stored email from {email_data['sender']} with ID: {doc_ref[1].id}")
-            return doc_ref[1].id
+            self.logger.info(f"Queued email from {email_data['sender']} with ID: {doc_ref.id}")
+            return doc_ref.id
 
         except Exception as e:
             self.logger.error(f"Failed to store email in Firebase: {e}")
             raise
 
+    def load_watermark(self):
+        """Read the persisted UID watermark and its UIDVALIDITY"""
+        snapshot = self.state_ref.get()
+        state = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        last_uid, uidvalidity = state.get('last_uid'), state.get('uidvalidity')
+        self.logger.info(f"Last ingested email UID: {last_uid} (UIDVALIDITY {uidvalidity})")
+        return last_uid, uidvalidity
+
+    def check_uidvalidity(self, mail):
+        """Reset the UID watermark if the selected mailbox's UIDs were reassigned"""
+        # Reported by the SELECT in connect_to_email; STATUS shouldn't be used on the selected mailbox
+        _, data = mail.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            raise ValueError("Email server did not report UIDVALIDITY")
+        uidvalidity = int(data[-1])
+        if self.uidvalidity is not None and uidvalidity != self.uidvalidity:
+            # Old UIDs mean nothing in the rebuilt mailbox; bootstrap again from unseen mail
+            self.logger.warning(f"UIDVALIDITY changed from {self.uidvalidity} to {uidvalidity}, resetting UID watermark")
+            self.last_uid = None
+        self.uidvalidity = uidvalidity
+
+    def flush_pending_emails(self, last_uid=None):
+        """Commit queued emails to Firestore in batches, advancing the UID watermark with the last batch; returns whether all of it committed"""
+        pending, self._pending = self._pending, []
+        # Leave room in every batch for the watermark write
+        chunk_size = FIRESTORE_BATCH_LIMIT - 1
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)] or [[]]
+        for index, chunk in enumerate(chunks):
+            is_last = index == len(chunks) - 1
+            if not chunk and not (is_last and last_uid is not None):
+                continue
+            try:
+                batch = self.db.batch()
+                for doc_ref, payload in chunk:
+                    batch.set(doc_ref, payload)
+                if is_last and last_uid is not None:
+                    batch.set(self.state_ref, {'last_uid': last_uid, 'uidvalidity': self.uidvalidity}, merge=True)
+                batch.commit()
+                if chunk:
+                    self.logger.info(f"Stored {len(chunk)} emails in Firebase")
+            except Exception as e:
+                # Keep the old watermark so the uncommitted messages are fetched again next cycle;
+                # their fixed document IDs make the retry overwrite rather than duplicate
+                self.logger.error(f"Failed to store {len(chunk)} emails in Firebase: {e}")
+                return False
+
+        if last_uid is not None:
+            self.last_uid = last_uid
+        return True
+
     def fetch_new_emails(self):
         """Fetch and process new emails"""
         mail = None
         try:
             mail = self.connect_to_email()
+            self.check_uidvalidity(mail)
 
-            # Search for unseen emails
-            status, email_ids = mail.search(None, 'UNSEEN')
+            # Search past the UID watermark; the very first run bootstraps from unseen emails
+            if self.last_uid is None:
+                criteria = 'UNSEEN'
+            else:
+                criteria = f'UID {self.last_uid + 1}:*'
+            status, uid_data = mail.uid('search', None, criteria)
 
             if status != 'OK':
                 self.logger.warning("Failed to search for emails")
                 return
 
-            email_id_list = email_ids[0].split()
-            self.logger.info(f"Found {len(email_id_list)} new emails")
+            # "N:*" always matches the highest UID, even when it is below N
+            uid_list = sorted(int(uid) for uid in uid_data[0].split() if int(uid) > (self.last_uid or 0))
+            self.logger.info(f"Found {len(uid_list)} new emails")
 
-            for email_id in email_id_list:
-                try:
-                    # Fetch email
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
+            # Each chunk is committed with its own watermark, so a failure only refetches that chunk
+            for start in range(0, len(uid_list), FETCH_CHUNK_SIZE):
+                chunk = uid_list[start:start + FETCH_CHUNK_SIZE]
 
-                    if status != 'OK':
-                        continue
+                # PEEK leaves the mailbox flags untouched
+                status, msg_data = mail.uid('fetch', uid_set(chunk), '(BODY.PEEK[])')
+
+                if status != 'OK':
+                    self.logger.warning("Failed to fetch emails")
+                    return
 
-                    # Parse email
-                    raw_email = msg_data[0][1]
-                    msg = email.message_from_bytes(raw_email)
-
-                    # Extract email data
-                    email_data = {
-                        'sender': self.parse_email_header(msg['From']),
-                        'subject': self.parse_email_header(msg['Subject']),
-                        'date': self.parse_email_header(msg['Date']),
-                        'message_id': self.parse_email_header(msg['Message-ID']),
-                        'body': self.extract_email_body(msg)
-                    }
-
-                    # Skip emails with empty bodies
-                    if not email_data['body'].strip():
-                        self.logger.warning(f"Skipping email with empty body from {email_data['sender']}")
+                # UIDs that must be fetched again: failed to queue, or possibly behind a literal without a UID
+                unhandled = set()
+                returned = set()
+                unattributed = 0
+                for uid, raw_email in self.iter_fetched_messages(msg_data):
+                    if uid is None:
+                        unattributed += 1
+                        continue
+                    returned.add(uid)
+                    # Messages skipped here (empty or unparseable) would be skipped again, so they count as handled
+                    email_data = self.parse_email(uid, raw_email)
+                    if email_data is None:
                         continue
 
                     # Store in Firebase
-                    self.store_email_in_firebase(email_data)
-
-                except Exception as e:
-                    self.logger.error(f"Failed to process email {email_id}: {e}")
-                    continue
+                    try:
+                        self.store_email_in_firebase(email_data)
+                    except Exception as e:
+                        unhandled.add(uid)
+                        self.logger.error(f"Failed to process email from {email_data['sender']}: {e}")
+
+                if unattributed:
+                    # Without a UID the literal can't be matched to its message; keep every unreturned UID pending.
+                    # When all literals carry UIDs, unreturned ones were expunged since the search.
+                    self.logger.error(f"{unattributed} FETCH responses carried no UID")
+                    unhandled.update(uid for uid in chunk if uid not in returned)
+
+                # The watermark only covers UIDs below the first one that still needs fetching
+                last_uid = min(unhandled) - 1 if unhandled else chunk[-1]
+                if last_uid <= (self.last_uid or 0):
+                    last_uid = None
+                if not self.flush_pending_emails(last_uid=last_uid) or unhandled:
+                    return
 
         except Exception as e:
             self.logger.error(f"Error in fetch_new_emails: {e}")
@@ -206,23 +360,95 @@ class EmailIngestionAgent:
                 except:
                     pass
 
+    def connect_idle_client(self):
+        """Open a read-only INBOX connection used only to wait in IMAP IDLE"""
+        client = IMAPClient(self.email_server, ssl=True)
+        try:
+            client.login(self.email_address, self.email_password)
+            if not client.has_capability('IDLE'):
+                self.logger.warning("Email server does not support IDLE, falling back to polling")
+                client.logout()
+                return None
+            client.select_folder('INBOX', readonly=True)
+            return client
+        except Exception:
+            client.shutdown()
+            raise
+
+    def wait_for_new_mail(self, client, timeout=IDLE_TIMEOUT):
+        """Block in IDLE until the server reports new mail or the timeout expires"""
+        def announces_new_mail(responses):
+            return any(len(r) > 1 and r[1] in (b'EXISTS', b'RECENT') for r in responses)
+
+        # Collect updates queued since the last command (e.g. mail that arrived during the fetch);
+        # left pending, an untagged EXISTS ahead of IDLE's '+' continuation makes idle() raise
+        _, responses = client.noop()
+        if announces_new_mail(responses):
+            return True
+
+        deadline = time.monotonic() + timeout
+        client.idle()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                responses = client.idle_check(timeout=remaining)
+                if announces_new_mail(responses):
+                    return True
+        finally:
+            client.idle_done()
+
     def run_continuous(self, check_interval=300):
-        """Run the agent continuously"""
+        """Run the agent continuously, waking on IMAP IDLE notifications"""
         self.logger.info(f"Starting email ingestion agent for app: {self.app_id}")
-        self.logger.info(f"Check interval: {check_interval} seconds")
+        self.logger.info(f"Polling fallback interval: {check_interval} seconds")
 
+        idle_client = None
+        use_idle = True
         while True:
             try:
+                # Enter the mailbox before fetching so mail arriving during the fetch still triggers IDLE
+                if use_idle and idle_client is None:
+                    idle_client = self.connect_idle_client()
+                    use_idle = idle_client is not None
+
                 self.fetch_new_emails()
-                self.logger.info(f"Sleeping for {check_interval} seconds...")
-                time.sleep(check_interval)
+
+                if idle_client:
+                    self.logger.info("Waiting for new mail (IDLE)...")
+                    try:
+                        self.wait_for_new_mail(idle_client)
+                    except IMAPClientError as e:
+                        # Mail announced between NOOP and IDLE breaks the handshake; reconnect and fetch right away
+                        self.logger.warning(f"IDLE interrupted ({e}), reconnecting")
+                        try:
+                            idle_client.shutdown()
+                        except:
+                            pass
+                        idle_client = None
+                else:
+                    self.logger.info(f"Sleeping for {check_interval} seconds...")
+                    time.sleep(check_interval)
             except KeyboardInterrupt:
                 self.logger.info("Shutting down email agent...")
                 break
             except Exception as e:
                 self.logger.error(f"Unexpected error: {e}")
+                if idle_client:
+                    try:
+                        idle_client.shutdown()
+                    except:
+                        pass
+                    idle_client = None
                 time.sleep(60)  # Wait 1 minute before retrying
 
+        if idle_client:
+            try:
+                idle_client.logout()
+            except:
+                pass
+
 if __name__ == "__main__":
     import os
     import sys
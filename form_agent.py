@@ -3,135 +3,171 @@ Form Ingestion Agent for Multi-Agent Sentiment Watchdog System
 Monitors web forms and webhooks for customer feedback
 """
 
-from flask import Flask, request, jsonify
+from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse, Response
+import orjson
+import uvicorn
 import logging
-from datetime import datetime
-from firebase_admin import firestore, credentials
+from logging.handlers import QueueHandler, QueueListener
+import queue
+from datetime import datetime, timezone
+import time
+from firebase_admin import firestore, firestore_async, credentials
 import firebase_admin
 import os
 from dotenv import load_dotenv
 import json
-import threading
-from werkzeug.serving import make_server
-import time
-import signal
-import sys
+from functools import lru_cache
+import random
+import fastjsonschema
 
 # Load environment variables
 load_dotenv()
 
+# Tickets are spread across this many processing shards (see SHARD_ID in processing_agent)
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '1'))
+
+# Webhook payload schema; forms may carry any extra fields alongside the message
+FORM_SCHEMA = {
+    'type': 'object',
+    'required': ['message'],
+    'properties': {
+        'message': {'type': 'string', 'minLength': 1, 'maxLength': 10000, 'pattern': '\\S'}
+    },
+    'additionalProperties': True
+}
+
+# (path, form_type, success message) for each webhook; all share one handler
+WEBHOOK_ROUTES = (
+    ('/webhook/contact-form', 'Contact', 'Contact form submitted successfully'),
+    ('/webhook/feedback', 'Feedback', 'Feedback submitted successfully'),
+    ('/webhook/support', 'Support', 'Support ticket submitted successfully'),
+    ('/webhook/custom', 'Custom', 'Form submitted successfully'),
+)
+
+@lru_cache(maxsize=1)
+def _get_db():
+    """Initialize Firebase once per process and return the shared Firestore client"""
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
+        if os.path.exists(cred_path):
+            cred = credentials.Certificate(cred_path)
+            firebase_admin.initialize_app(cred)
+        else:
+            cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
+            if cred_json:
+                cred_dict = json.loads(cred_json)
+                cred = credentials.Certificate(cred_dict)
+                firebase_admin.initialize_app(cred)
+            else:
+                raise ValueError("Firebase credentials not found")
+    # The async client's channel binds to the server's event loop on the first request
+    return firestore_async.client()
+
+@lru_cache(maxsize=1)
+def _health_body(app_id, second):
+    """Encoded /health response; probes within the same wall-clock second reuse it"""
+    return orjson.dumps({
+        'status': 'healthy',
+        'agent': 'FormIngestionAgent',
+        'app_id': app_id,
+        'timestamp': datetime.fromtimestamp(second, timezone.utc).isoformat()
+    })
+
 class FormIngestionAgent:
     def __init__(self, app_id, port=5000):
         self.app_id = app_id
         self.port = port
         self.setup_logging()
         self.init_firebase()
-        self.setup_flask_app()
+        # Compiled once into plain Python code instead of interpreting the schema per request
+        self._validate = fastjsonschema.compile(FORM_SCHEMA)
+        self.setup_app()
         self.server = None
 
     def setup_logging(self):
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(f'form_agent_{self.app_id}.log'),
-                logging.StreamHandler()
-            ]
-        )
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        file_handler = logging.FileHandler(f'form_agent_{self.app_id}.log')
+        stream_handler = logging.StreamHandler()
+        file_handler.setFormatter(formatter)
+        stream_handler.setFormatter(formatter)
+        # Request handlers only enqueue records; a background thread does the file and console writes
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        # prepare() bakes the formatted message into the record; keep it bare so the listener's formatter adds the prefix once
+        queue_handler.setFormatter(logging.Formatter('%(message)s'))
+        root = logging.getLogger()
+        root.addHandler(queue_handler)
+        root.setLevel(logging.INFO)
+        self.log_listener = QueueListener(log_queue, file_handler, stream_handler)
+        self.log_listener.start()
         self.logger = logging.getLogger(f'FormAgent_{self.app_id}')
 
     def init_firebase(self):
-        try:
-            firebase_admin.get_app()
-        except ValueError:
-            cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
-            if os.path.exists(cred_path):
-                cred = credentials.Certificate(cred_path)
-                firebase_admin.initialize_app(cred)
-            else:
-                cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
-                if cred_json:
-                    cred_dict = json.loads(cred_json)
-                    cred = credentials.Certificate(cred_dict)
-                    firebase_admin.initialize_app(cred)
-                else:
-                    raise ValueError("Firebase credentials not found")
-        self.db = firestore.client()
+        self.db = _get_db()
         self.logger.info("Firebase initialized successfully")
 
-    def setup_flask_app(self):
-        self.app = Flask(__name__)
-        self.app.logger.setLevel(logging.INFO)
-
-        @self.app.route('/health', methods=['GET'])
-        def health_check():
-            return jsonify({
-                'status': 'healthy',
-                'agent': 'FormIngestionAgent',
-                'app_id': self.app_id,
-                'timestamp': datetime.utcnow().isoformat()
-            })
-
-        @self.app.route('/webhook/contact-form', methods=['POST'])
-        def contact_form_webhook():
-            return self.handle_contact_form()
+    def setup_app(self):
+        self.app = FastAPI(default_response_class=ORJSONResponse)
 
-        @self.app.route('/webhook/feedback', methods=['POST'])
-        def feedback_webhook():
-            return self.handle_feedback_form()
+        @self.app.get('/health')
+        async def health_check():
+            return Response(_health_body(self.app_id, int(time.time())), media_type='application/json')
 
-        @self.app.route('/webhook/support', methods=['POST'])
-        def support_webhook():
-            return self.handle_support_form()
+        for path, form_type, success_message in WEBHOOK_ROUTES:
+            self.app.add_api_route(path, self.make_webhook(form_type, success_message),
+                                   methods=['POST'], name=f'{form_type.lower()}_webhook')
 
-        @self.app.route('/webhook/custom', methods=['POST'])
-        def custom_webhook():
-            return self.handle_custom_form()
-
-        @self.app.errorhandler(400)
-        def bad_request(error):
-            self.logger.warning(f"Bad request: {error}")
-            return jsonify({'error': 'Bad request', 'message': str(error)}), 400
-
-        @self.app.errorhandler(500)
-        def internal_error(error):
+        @self.app.exception_handler(Exception)
+        async def internal_error(request: Request, error: Exception):
             self.logger.error(f"Internal error: {error}")
-            return jsonify({'error': 'Internal server error'}), 500
+            return ORJSONResponse({'error': 'Internal server error'}, status_code=500)
+
+    async def read_json(self, request):
+        """Return the decoded JSON body, or None if it is missing or malformed"""
+        try:
+            return orjson.loads(await request.body())
+        except ValueError as e:
+            self.logger.warning(f"Bad request: {e}")
+            return None
 
     def validate_form_data(self, data):
-        if not isinstance(data, dict):
-            return False, "Data must be a JSON object"
-        required_fields = ['message']
-        for field in required_fields:
-            if field not in data or not data[field].strip():
-                return False, f"Missing required field: {field}"
-        if len(data['message']) > 10000:
-            return False, "Message too long (max 10000 characters)"
-        return True, "Valid"
+        try:
+            self._validate(data)
+            return True, "Valid"
+        except fastjsonschema.JsonSchemaValueException as e:
+            return False, e.message
 
-    def extract_form_metadata(self, data):
+    def extract_form_metadata(self, data, request):
+        headers = request.headers
         metadata = {
-            'user_agent': request.headers.get('User-Agent', ''),
-            'ip_address': request.remote_addr,
-            'referer': request.headers.get('Referer', ''),
-            'submission_time': datetime.utcnow().isoformat(),
-            'form_fields': list(data.keys())
+            'user_agent': headers.get('user-agent', ''),
+            'ip_address': request.client.host if request.client else None,
+            'referer': headers.get('referer', ''),
+            'submission_time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'form_fields': list(data)
         }
         return metadata
 
-    def store_form_submission(self, form_data, form_type):
+    async def store_form_submission(self, form_data, form_type, request):
         try:
+            # One copy of the payload serves as both the message and the remaining form fields
+            fields = dict(form_data)
+            message = fields.pop('message')
             doc_data = {
                 'source': f'Form_{form_type}',
                 'timestamp': firestore.SERVER_TIMESTAMP,
-                'message': form_data['message'],
+                'message': message,
                 'subject': form_data.get('subject', f'{form_type} Submission'),
                 'sender': form_data.get('email', form_data.get('contact_email', 'unknown@unknown.com')),
                 'status': 'new',
+                'shard': random.randrange(NUM_SHARDS),
                 'form_type': form_type,
                 'raw_data': {
-                    'form_fields': {k: v for k, v in form_data.items() if k != 'message'},
-                    'metadata': self.extract_form_metadata(form_data)
+                    'form_fields': fields,
+                    'metadata': self.extract_form_metadata(form_data, request)
                 }
             }
             if 'name' in form_data:
@@ -140,96 +176,51 @@ class FormIngestionAgent:
                 doc_data['customer_phone'] = form_data['phone']
             if 'company' in form_data:
                 doc_data['customer_company'] = form_data['company']
-            doc_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').add(doc_data)
+            doc_ref = await self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').add(doc_data)
             self.logger.info(f"Stored {form_type} form submission with ID: {doc_ref[1].id}")
             return doc_ref[1].id
         except Exception as e:
             self.logger.error(f"Failed to store form submission: {e}")
             raise
 
-    def handle_contact_form(self):
-        try:
-            data = request.get_json()
-            if not data:
-                return jsonify({'error': 'No JSON data provided'}), 400
-            is_valid, message = self.validate_form_data(data)
-            if not is_valid:
-                return jsonify({'error': message}), 400
-            submission_id = self.store_form_submission(data, 'Contact')
-            return jsonify({
-                'status': 'success',
-                'message': 'Contact form submitted successfully',
-                'submission_id': submission_id
-            })
-        except Exception as e:
-            self.logger.error(f"Error handling contact form: {e}")
-            return jsonify({'error': 'Internal server error'}), 500
-
-    def handle_feedback_form(self):
-        try:
-            data = request.get_json()
-            if not data:
-                return jsonify({'error': 'No JSON data provided'}), 400
-            is_valid, message = self.validate_form_data(data)
-            if not is_valid:
-                return jsonify({'error': message}), 400
-            submission_id = self.store_form_submission(data, 'Feedback')
-            return jsonify({
-                'status': 'success',
-                'message': 'Feedback submitted successfully',
-                'submission_id': submission_id
-            })
-        except Exception as e:
-            self.logger.error(f"Error handling feedback form: {e}")
-            return jsonify({'error': 'Internal server error'}), 500
-
-    def handle_support_form(self):
-        try:
-            data = request.get_json()
-            if not data:
-                return jsonify({'error': 'No JSON data provided'}), 400
-            is_valid, message = self.validate_form_data(data)
-            if not is_valid:
-                return jsonify({'error': message}), 400
-            submission_id = self.store_form_submission(data, 'Support')
-            return jsonify({
-                'status': 'success',
-                'message': 'Support ticket submitted successfully',
-                'submission_id': submission_id
-            })
-        except Exception as e:
-            self.logger.error(f"Error handling support form: {e}")
-            return jsonify({'error': 'Internal server error'}), 500
+    def make_webhook(self, form_type, success_message):
+        """Build the FastAPI endpoint for one form type"""
+        async def webhook(request: Request):
+            return await self.handle_form(request, form_type, success_message)
+        return webhook
 
-    def handle_custom_form(self):
+    async def handle_form(self, request, form_type, success_message):
         try:
-            data = request.get_json()
+            data = await self.read_json(request)
             if not data:
-                return jsonify({'error': 'No JSON data provided'}), 400
+                return ORJSONResponse({'error': 'No JSON data provided'}, status_code=400)
             is_valid, message = self.validate_form_data(data)
             if not is_valid:
-                return jsonify({'error': message}), 400
-            submission_id = self.store_form_submission(data, 'Custom')
-            return jsonify({
+                return ORJSONResponse({'error': message}, status_code=400)
+            submission_id = await self.store_form_submission(data, form_type, request)
+            return {
                 'status': 'success',
-                'message': 'Form submitted successfully',
+                'message': success_message,
                 'submission_id': submission_id
-            })
+            }
         except Exception as e:
-            self.logger.error(f"Error handling custom form: {e}")
-            return jsonify({'error': 'Internal server error'}), 500
+            self.logger.error(f"Error handling {form_type.lower()} form: {e}")
+            return ORJSONResponse({'error': 'Internal server error'}, status_code=500)
 
     def start_server(self):
         try:
-            self.server = make_server('0.0.0.0', self.port, self.app, threaded=True)
+            config = uvicorn.Config(
+                self.app, host='0.0.0.0', port=self.port,
+                loop='uvloop', http='httptools', log_level='info',
+                log_config=None  # uvicorn and access logs propagate to the root queue handler
+            )
+            self.server = uvicorn.Server(config)
             self.logger.info(f"Form ingestion agent starting on port {self.port}")
             self.logger.info("Webhook endpoints available:")
             self.logger.info(f"  - Health check: http://localhost:{self.port}/health")
-            self.logger.info(f"  - Contact form: http://localhost:{self.port}/webhook/contact-form")
-            self.logger.info(f"  - Feedback form: http://localhost:{self.port}/webhook/feedback")
-            self.logger.info(f"  - Support form: http://localhost:{self.port}/webhook/support")
-            self.logger.info(f"  - Custom form: http://localhost:{self.port}/webhook/custom")
-            self.server.serve_forever()
+            for path, form_type, _ in WEBHOOK_ROUTES:
+                self.logger.info(f"  - {form_type} form: http://localhost:{self.port}{path}")
+            self.server.run()
         except Exception as e:
             self.logger.error(f"Failed to start server: {e}")
             raise
@@ -237,16 +228,15 @@ class FormIngestionAgent:
     def stop_server(self):
         if self.server:
             self.logger.info("Stopping form ingestion agent...")
-            self.server.shutdown()
+            self.server.should_exit = True
 
     def run(self):
-        def signal_handler(signum, frame):
-            self.logger.info("Received shutdown signal")
-            self.stop_server()
-            sys.exit(0)
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
-        self.start_server()
+        # Uvicorn installs its own SIGINT/SIGTERM handlers and shuts down gracefully
+        try:
+            self.start_server()
+        finally:
+            # Flush records still waiting in the queue
+            self.log_listener.stop()
 
 if __name__ == "__main__":
     import os
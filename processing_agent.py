@@ -3,37 +3,137 @@ Sentiment Analysis & Processing Agent for Multi-Agent Sentiment Watchdog System
 Processes raw customer messages using Gemini API for sentiment analysis
 """
 
-import time
+import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from firebase_admin import firestore
 from firebase_admin import credentials
 import firebase_admin
 import os
 from dotenv import load_dotenv
 import json
-import google.generativeai as genai
-from retrying import retry
+import hashlib
+from functools import lru_cache
+from cachetools import LRUCache
+import httpx
+from aiolimiter import AsyncLimiter
+from tenacity import retry, wait_random_exponential, retry_if_exception
 import signal
 import sys
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import re
+import random
+import socket
 
 # Load environment variables
 load_dotenv()
 
+# Firestore rejects batches with more than 500 writes
+FIRESTORE_BATCH_LIMIT = 500
+
+# Gemini REST endpoint, called directly so every request shares one pooled HTTP/2 client
+GEMINI_MODEL = 'gemini-2.0-flash-exp'
+# Server-sent events: each event carries the next chunk of the candidate's text
+GEMINI_URL = f'https://generativelanguage.googleapis.com/v1beta/models/{GEMINI_MODEL}:streamGenerateContent?alt=sse'
+
+# Structured output: Gemini returns bare JSON matching this schema, so no fences or examples are needed
+SENTIMENT_GENERATION_CONFIG = {
+    'temperature': 0.1,
+    'maxOutputTokens': 500,
+    'responseMimeType': 'application/json',
+    'responseSchema': {
+        'type': 'OBJECT',
+        'properties': {
+            'sentiment': {'type': 'STRING', 'format': 'enum', 'enum': ['anger', 'confusion', 'delight', 'neutral']},
+            'summary': {'type': 'STRING'},
+            'confidence': {'type': 'NUMBER'},
+            'keywords': {'type': 'ARRAY', 'items': {'type': 'STRING'}}
+        },
+        'required': ['sentiment', 'summary', 'confidence', 'keywords']
+    }
+}
+
+# Must match NUM_SHARDS on the ingestion agents; each worker owns one SHARD_ID in [0, NUM_SHARDS)
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '1'))
+
+# A 'processing' claim older than this is treated as abandoned by a dead worker and may be taken over
+CLAIM_LEASE = timedelta(seconds=int(os.getenv('CLAIM_LEASE_SECONDS', '600')))
+
+# Sentiment results kept in memory, keyed by SHA-256 of the cleaned message
+SENTIMENT_CACHE_SIZE = 10_000
+
+# Patterns used by clean_text, compiled once at import
+_WS = re.compile(r'\s+')
+_EMAIL_HDR = re.compile(r'^(From:|To:|Subject:|Date:).*$', re.MULTILINE)
+_SIG = re.compile(r'^--.*$', re.MULTILINE)
+_URL = re.compile(r'https?://\S+')
+_DOTS = re.compile(r'\.{3,}')
+_BANGS = re.compile(r'!{2,}')
+_QS = re.compile(r'\?{2,}')
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Retry throttling, server errors, transport failures and malformed output, but not 4xx client errors"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    # ValueError covers malformed model output (including json.JSONDecodeError)
+    return isinstance(exc, (httpx.TransportError, ValueError))
+
+def _stop_after_max_retries(retry_state) -> bool:
+    """Stop once the agent's MAX_RETRIES attempts (the first call included) are used up"""
+    return retry_state.attempt_number >= retry_state.args[0].max_retries
+
+@lru_cache(maxsize=1)
+def _get_db():
+    """Initialize Firebase once per process and return the shared Firestore client"""
+    try:
+        # Check if Firebase app is already initialized
+        firebase_admin.get_app()
+    except ValueError:
+        # Initialize Firebase if not already done
+        cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
+        if os.path.exists(cred_path):
+            cred = credentials.Certificate(cred_path)
+            firebase_admin.initialize_app(cred)
+        else:
+            # Use environment variable for credentials
+            cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
+            if cred_json:
+                cred_dict = json.loads(cred_json)
+                cred = credentials.Certificate(cred_dict)
+                firebase_admin.initialize_app(cred)
+            else:
+                raise ValueError("Firebase credentials not found")
+    return firestore.client()
+
 class SentimentProcessingAgent:
     def __init__(self, app_id):
         self.app_id = app_id
+        # Shard this worker owns; unset means watch every new ticket (single worker)
+        shard_id = os.getenv('SHARD_ID')
+        self.shard_id = int(shard_id) if shard_id else None
+        if self.shard_id is not None and not 0 <= self.shard_id < NUM_SHARDS:
+            raise ValueError(f"SHARD_ID {self.shard_id} is outside [0, NUM_SHARDS={NUM_SHARDS})")
+        # Recorded on every claim so a stuck ticket shows which worker took it
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}'
         self.setup_logging()
         self.init_firebase()
-        self.init_gemini()
         self.running = True
+        self._loop = None
 
         # Processing configuration
         self.batch_size = int(os.getenv('PROCESSING_BATCH_SIZE', '10'))
-        self.processing_interval = int(os.getenv('PROCESSING_INTERVAL', '60'))
-        self.max_retries = int(os.getenv('MAX_RETRIES', '3'))
+        # Total Gemini attempts per message; read by the retry policy's stop condition
+        self.max_retries = max(1, int(os.getenv('MAX_RETRIES', '3')))
+
+        # Gemini throttling: aggregate requests per minute, and how many calls may be in flight
+        self.gemini_rpm = int(os.getenv('GEMINI_RPM', '30'))
+        self.gemini_concurrency = int(os.getenv('GEMINI_CONCURRENCY', '5'))
+        self._rate_limiter = AsyncLimiter(self.gemini_rpm, 60)
+        self._gemini_slots = asyncio.Semaphore(self.gemini_concurrency)
+        self.init_gemini()
+
+        # Autoresponders, retried submissions and spam repeat verbatim; analyze each text once
+        self._sentiment_cache = LRUCache(maxsize=SENTIMENT_CACHE_SIZE)
 
     def setup_logging(self):
         """Setup logging configuration"""
@@ -49,26 +149,11 @@ class SentimentProcessingAgent:
 
     def init_firebase(self):
         """Initialize Firebase Admin SDK"""
-        try:
-            # Check if Firebase app is already initialized
-            firebase_admin.get_app()
-        except ValueError:
-            # Initialize Firebase if not already done
-            cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', 'serviceAccountKey.json')
-            if os.path.exists(cred_path):
-                cred = credentials.Certificate(cred_path)
-                firebase_admin.initialize_app(cred)
-            else:
-                # Use environment variable for credentials
-                cred_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
-                if cred_json:
-                    cred_dict = json.loads(cred_json)
-                    cred = credentials.Certificate(cred_dict)
-                    firebase_admin.initialize_app(cred)
-                else:
-                    raise ValueError("Firebase credentials not found")
-
-        self.db = firestore.client()
+        self.db = _get_db()
+        # Tickets awaiting analysis; watched with a snapshot listener rather than polled
+        self.pending_query = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').where('status', '==', 'new')
+        if self.shard_id is not None:
+            self.pending_query = self.pending_query.where('shard', '==', self.shard_id)
         self.logger.info("Firebase initialized successfully")
 
     def init_gemini(self):
@@ -77,86 +162,82 @@ class SentimentProcessingAgent:
         if not api_key:
             raise ValueError("GEMINI_API_KEY not found in environment variables")
 
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        self._gemini_headers = {'x-goog-api-key': api_key}
+        # Keepalive connections are reused across batches; HTTP/2 multiplexes the concurrent calls.
+        # The pool matches the in-flight limit (one connection per call if HTTP/2 isn't negotiated), and
+        # idle connections outlive the gap between listener batches instead of paying a new TLS handshake.
+        self._hx = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=self.gemini_concurrency,
+                max_connections=self.gemini_concurrency,
+                keepalive_expiry=120
+            ),
+            timeout=30
+        )
         self.logger.info("Gemini API initialized successfully")
 
+    async def generate_content(self, prompt: str, generation_config: Dict) -> str:
+        """Stream Gemini generateContent and return the concatenated text of the first candidate"""
+        chunks = []
+        async with self._hx.stream('POST', GEMINI_URL, headers=self._gemini_headers, json={
+            'contents': [{'parts': [{'text': prompt}]}],
+            'generationConfig': generation_config
+        }) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                candidates = json.loads(line[5:]).get('candidates') or [{}]
+                parts = candidates[0].get('content', {}).get('parts', [])
+                chunks.extend(part.get('text', '') for part in parts)
+        return ''.join(chunks)
+
     def clean_text(self, text: str) -> str:
         """Clean and prepare text for analysis"""
         if not text:
             return ""
 
         # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text.strip())
+        text = _WS.sub(' ', text.strip())
 
         # Remove email headers and signatures
-        text = re.sub(r'^(From:|To:|Subject:|Date:).*$', '', text, flags=re.MULTILINE)
-        text = re.sub(r'^--.*$', '', text, flags=re.MULTILINE)
+        text = _EMAIL_HDR.sub('', text)
+        text = _SIG.sub('', text)
 
         # Remove URLs
-        text = re.sub(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', '', text)
+        text = _URL.sub('', text)
 
         # Remove excessive punctuation
-        text = re.sub(r'[.]{3,}', '...', text)
-        text = re.sub(r'[!]{2,}', '!', text)
-        text = re.sub(r'[?]{2,}', '?', text)
+        text = _DOTS.sub('...', text)
+        text = _BANGS.sub('!', text)
+        text = _QS.sub('?', text)
 
         return text.strip()
 
-    @retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000)
-    def analyze_sentiment_with_gemini(self, message: str) -> Dict:
-        """Analyze sentiment using Gemini API with retry logic"""
+    # Jittered backoff so concurrent calls hitting a 429 don't all retry in lockstep
+    @retry(
+        stop=_stop_after_max_retries,
+        wait=wait_random_exponential(multiplier=1, max=10),
+        retry=retry_if_exception(_is_retryable),
+        reraise=True
+    )
+    async def analyze_sentiment_with_gemini(self, cleaned_message: str) -> Dict:
+        """Analyze sentiment of an already cleaned message using Gemini API with retry logic"""
         try:
-            cleaned_message = self.clean_text(message)
-
-            if len(cleaned_message) < 10:
-                return {
-                    'sentiment': 'neutral',
-                    'summary': 'Message too short for analysis',
-                    'confidence': 0.5,
-                    'keywords': []
-                }
-
-            prompt = f"""Analyze the sentiment of the following customer support message. Categorize the sentiment as one of: 'anger', 'confusion', 'delight', or 'neutral'. 
+            prompt = f"""Analyze the sentiment of the following customer support message. Categorize the sentiment as one of: 'anger', 'confusion', 'delight', or 'neutral'.
 
-Provide a confidence score (0.0 to 1.0), a brief summary of the core issue or feeling expressed, and extract key keywords that indicate the sentiment.
-
-Respond in JSON format with these exact keys:
-- "sentiment": one of "anger", "confusion", "delight", or "neutral"
-- "summary": brief summary of the issue/feeling (max 100 characters)
-- "confidence": confidence score between 0.0 and 1.0
-- "keywords": array of relevant keywords (max 5 keywords)
-
-Examples:
-Input: "My internet has been down for 3 days! This is unacceptable, I need it fixed NOW!"
-Output: {{"sentiment": "anger", "summary": "Customer frustrated by 3-day internet outage", "confidence": 0.95, "keywords": ["frustrated", "outage", "unacceptable", "down", "fix"]}}
-
-Input: "Thank you so much for the quick resolution! The team was amazing and very helpful."
-Output: {{"sentiment": "delight", "summary": "Customer pleased with quick and helpful service", "confidence": 0.9, "keywords": ["thank you", "quick", "amazing", "helpful", "resolution"]}}
-
-Input: "I'm not sure how to set up my new router. Can someone help me understand the process?"
-Output: {{"sentiment": "confusion", "summary": "Customer needs help with router setup", "confidence": 0.8, "keywords": ["not sure", "help", "router", "setup", "understand"]}}
+Provide a confidence score (0.0 to 1.0), a brief summary of the core issue or feeling expressed (max 100 characters), and up to 5 keywords that indicate the sentiment.
 
 Message to analyze:
 {cleaned_message}"""
 
-            response = self.model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.1,
-                    max_output_tokens=500
-                )
-            )
+            # Every attempt takes its own rate-limit token; the slot is released during backoff
+            async with self._gemini_slots, self._rate_limiter:
+                response_text = await self.generate_content(prompt, SENTIMENT_GENERATION_CONFIG)
 
-            if not response.text:
-                raise Exception("Empty response from Gemini API")
-
-            # Clean the response text
-            response_text = response.text.strip()
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
+            if not response_text:
+                raise ValueError("Empty response from Gemini API")
 
             # Parse JSON response
             result = json.loads(response_text)
@@ -185,138 +266,263 @@ Message to analyze:
             # Limit keywords to 5
             result['keywords'] = result['keywords'][:5]
 
-            self.logger.debug(f"Sentiment analysis result: {result}")
+            self.logger.debug("Sentiment analysis result: %s", result)
             return result
 
         except json.JSONDecodeError as e:
             self.logger.error(f"Failed to parse Gemini response as JSON: {e}")
-            raise Exception(f"Invalid JSON response from Gemini: {e}")
+            raise
         except Exception as e:
             self.logger.error(f"Error in sentiment analysis: {e}")
             raise
 
-    def get_pending_tickets(self) -> List[Dict]:
-        """Retrieve tickets pending sentiment analysis"""
-        try:
-            tickets_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets')
-
-            # Query for new tickets
-            query = tickets_ref.where('status', '==', 'new').limit(self.batch_size)
-            docs = query.get()
-
-            tickets = []
-            for doc in docs:
-                ticket_data = doc.to_dict()
-                ticket_data['id'] = doc.id
-                tickets.append(ticket_data)
-
-            self.logger.info(f"Retrieved {len(tickets)} pending tickets")
-            return tickets
+    def backfill_unsharded_tickets(self):
+        """Give a shard to 'new' tickets written before sharding; a shard filter never matches them otherwise"""
+        tickets_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets')
+        # Projecting onto 'shard' leaves unsharded tickets with an empty dict
+        unsharded = [snapshot.reference
+                     for snapshot in tickets_ref.where('status', '==', 'new').select(['shard']).stream()
+                     if 'shard' not in (snapshot.to_dict() or {})]
+        for start in range(0, len(unsharded), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            for doc_ref in unsharded[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.update(doc_ref, {'shard': random.randrange(NUM_SHARDS)})
+            batch.commit()
+        if unsharded:
+            self.logger.info(f"Assigned shards to {len(unsharded)} unsharded tickets")
+
+    def on_pending_tickets(self, snapshots, changes, read_time):
+        """Snapshot listener callback; runs on the listener's thread and hands new tickets to the event loop"""
+        for change in changes:
+            if change.type.name != 'ADDED':
+                continue
+            # Only the message is analyzed; don't hold raw_data/metadata in the queue
+            data = change.document.to_dict() or {}
+            ticket_data = {'id': change.document.id, 'message': data.get('message', '')}
+            self._loop.call_soon_threadsafe(self.enqueue_ticket, ticket_data)
+
+    def enqueue_ticket(self, ticket: Dict):
+        # The listener re-sends every matching document when it reconnects; queue each ticket once
+        if ticket['id'] in self._queued_ids:
+            return
+        self._queued_ids.add(ticket['id'])
+        self._queue.put_nowait(ticket)
 
-        except Exception as e:
-            self.logger.error(f"Error retrieving pending tickets: {e}")
+    async def next_tickets_batch(self) -> List[Dict]:
+        """Wait for the next pending ticket, then drain whatever else is queued up to batch_size"""
+        ticket = await self._queue.get()
+        if ticket is None:  # shutdown wake-up
             return []
+        tickets = [ticket]
+        while len(tickets) < self.batch_size and not self._queue.empty():
+            ticket = self._queue.get_nowait()
+            if ticket is not None:
+                tickets.append(ticket)
+        self.logger.info(f"Retrieved {len(tickets)} pending tickets")
+        return tickets
+
+    def stop(self):
+        """Stop processing after the current batch"""
+        self.running = False
+        if self._loop:
+            # Wake the consumer if it is waiting on an empty queue
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    def claim_tickets(self, tickets: List[Dict]) -> List[Dict]:
+        """Atomically move tickets from 'new' (or an expired claim) to 'processing', returning the ones this worker now owns"""
+        tickets_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets')
+        # Tickets requeued after a failed batch were already claimed by this worker
+        claimed = [ticket for ticket in tickets if ticket.get('claimed')]
+        unclaimed = [ticket for ticket in tickets if not ticket.get('claimed')]
+
+        lease_cutoff = datetime.now(timezone.utc) - CLAIM_LEASE
+
+        @firestore.transactional
+        def claim(transaction, refs):
+            # All reads must happen before the first write; contention retries the whole function
+            snapshots = list(transaction.get_all(refs))
+            owned = set()
+            for snapshot in snapshots:
+                data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+                claimed_at = data.get('claimed_at')
+                expired = data.get('status') == 'processing' and (claimed_at is None or claimed_at < lease_cutoff)
+                if data.get('status') == 'new' or expired:
+                    transaction.update(snapshot.reference, {
+                        'status': 'processing',
+                        'claimed_at': firestore.SERVER_TIMESTAMP,
+                        'claimed_by': self.worker_id
+                    })
+                    owned.add(snapshot.id)
+            return owned
+
+        for start in range(0, len(unclaimed), FIRESTORE_BATCH_LIMIT):
+            chunk = unclaimed[start:start + FIRESTORE_BATCH_LIMIT]
+            owned = claim(self.db.transaction(), [tickets_ref.document(ticket['id']) for ticket in chunk])
+            for ticket in chunk:
+                if ticket['id'] in owned:
+                    ticket['claimed'] = True
+                    claimed.append(ticket)
+                else:
+                    # Taken by another worker (or no longer new) since the listener saw it
+                    self._queued_ids.discard(ticket['id'])
+
+        if len(claimed) < len(tickets):
+            self.logger.info(f"Skipped {len(tickets) - len(claimed)} tickets already claimed elsewhere")
+        return claimed
+
+    def recover_abandoned_claims(self):
+        """Requeue 'processing' tickets of this shard, each once its claim lease has lapsed"""
+        query = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').where('status', '==', 'processing')
+        if self.shard_id is not None:
+            query = query.where('shard', '==', self.shard_id)
+        now = datetime.now(timezone.utc)
+        recovered = 0
+        for snapshot in query.select(['message', 'claimed_at']).stream():
+            data = snapshot.to_dict() or {}
+            claimed_at = data.get('claimed_at')
+            # The listener only sees 'new' tickets; claim_tickets re-checks the lease in its transaction
+            delay = (claimed_at + CLAIM_LEASE - now).total_seconds() if claimed_at else 0
+            ticket = {'id': snapshot.id, 'message': data.get('message', '')}
+            self._loop.call_later(max(delay, 0), self.enqueue_ticket, ticket)
+            recovered += 1
+        if recovered:
+            self.logger.info(f"Requeued {recovered} tickets left in 'processing' by an earlier worker")
+
+    def update_ticket_statuses(self, updates: List[Tuple[str, str, Optional[Dict]]]):
+        """Update status and sentiment data for (ticket_id, status, sentiment_data) triples in batched commits"""
+        tickets_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets')
+        for start in range(0, len(updates), FIRESTORE_BATCH_LIMIT):
+            chunk = updates[start:start + FIRESTORE_BATCH_LIMIT]
+            try:
+                batch = self.db.batch()
+                for ticket_id, status, sentiment_data in chunk:
+                    update_data = {
+                        'status': status,
+                        'processed_timestamp': firestore.SERVER_TIMESTAMP
+                    }
+
+                    if sentiment_data:
+                        update_data.update({
+                            'sentiment': sentiment_data['sentiment'],
+                            'summary': sentiment_data['summary'],
+                            'confidence': sentiment_data['confidence'],
+                            'keywords': sentiment_data['keywords']
+                        })
+
+                    batch.update(tickets_ref.document(ticket_id), update_data)
+                    self.logger.debug("Updated ticket %s with status: %s", ticket_id, status)
+                batch.commit()
 
-    def update_ticket_status(self, ticket_id: str, status: str, sentiment_data: Optional[Dict] = None):
-        """Update ticket status and sentiment data"""
-        try:
-            ticket_ref = self.db.collection(f'artifacts/{self.app_id}/public/data/raw_tickets').document(ticket_id)
-
-            update_data = {
-                'status': status,
-                'processed_timestamp': firestore.SERVER_TIMESTAMP
+            except Exception as e:
+                self.logger.error(f"Error updating {len(chunk)} tickets: {e}")
+                raise
+
+    async def analyze_ticket(self, ticket: Dict) -> Tuple[str, str, Optional[Dict]]:
+        """Analyze one ticket, returning its (ticket_id, status, sentiment_data) update"""
+        ticket_id = ticket['id']
+        message = ticket.get('message', '')
+
+        if not message.strip():
+            self.logger.warning(f"Ticket {ticket_id} has empty message, marking as error")
+            return ticket_id, 'error', None
+
+        cleaned_message = self.clean_text(message)
+
+        if len(cleaned_message) < 10:
+            sentiment_result = {
+                'sentiment': 'neutral',
+                'summary': 'Message too short for analysis',
+                'confidence': 0.5,
+                'keywords': []
             }
-
-            if sentiment_data:
-                update_data.update({
-                    'sentiment': sentiment_data['sentiment'],
-                    'summary': sentiment_data['summary'],
-                    'confidence': sentiment_data['confidence'],
-                    'keywords': sentiment_data['keywords']
-                })
-
-            ticket_ref.update(update_data)
-            self.logger.debug(f"Updated ticket {ticket_id} with status: {status}")
-
-        except Exception as e:
-            self.logger.error(f"Error updating ticket {ticket_id}: {e}")
-            raise
-
-    def process_tickets_batch(self):
+        else:
+            # Cache hits skip both the API call and the rate limiter
+            cache_key = hashlib.sha256(cleaned_message.encode()).digest()
+            sentiment_result = self._sentiment_cache.get(cache_key)
+            if sentiment_result is None:
+                sentiment_result = await self.analyze_sentiment_with_gemini(cleaned_message)
+                self._sentiment_cache[cache_key] = sentiment_result
+
+        self.logger.info(f"Processed ticket {ticket_id}: {sentiment_result['sentiment']} "
+                       f"(confidence: {sentiment_result['confidence']:.2f})")
+        return ticket_id, 'processed', sentiment_result
+
+    async def process_tickets_batch(self, tickets: List[Dict]):
         """Process a batch of tickets for sentiment analysis"""
-        tickets = self.get_pending_tickets()
-
-        if not tickets:
-            self.logger.debug("No pending tickets to process")
-            return
-
         processed_count = 0
         error_count = 0
+        # Status changes are collected and committed together once the batch is analyzed
+        updates = []
+
+        results = await asyncio.gather(*(self.analyze_ticket(ticket) for ticket in tickets), return_exceptions=True)
+        for ticket, result in zip(tickets, results):
+            if isinstance(result, Exception):
+                self.logger.error(f"Error processing ticket {ticket.get('id', 'unknown')}: {result}")
+                if 'id' in ticket:
+                    updates.append((ticket['id'], 'error', None))
+                error_count += 1
+                continue
 
-        for ticket in tickets:
-            try:
-                ticket_id = ticket['id']
-                message = ticket.get('message', '')
-
-                if not message.strip():
-                    self.logger.warning(f"Ticket {ticket_id} has empty message, marking as error")
-                    self.update_ticket_status(ticket_id, 'error')
-                    error_count += 1
-                    continue
-
-                # Mark as processing
-                self.update_ticket_status(ticket_id, 'processing')
+            updates.append(result)
+            if result[1] == 'processed':
+                processed_count += 1
+            else:
+                error_count += 1
 
-                # Analyze sentiment
-                sentiment_result = self.analyze_sentiment_with_gemini(message)
+        self.update_ticket_statuses(updates)
 
-                # Update with results
-                self.update_ticket_status(ticket_id, 'processed', sentiment_result)
-                processed_count += 1
+        self.logger.info(f"Batch processing complete: {processed_count} processed, {error_count} errors")
 
-                self.logger.info(f"Processed ticket {ticket_id}: {sentiment_result['sentiment']} "
-                               f"(confidence: {sentiment_result['confidence']:.2f})")
+    async def process_continuously(self):
+        """Consume tickets pushed by the snapshot listener; all batches share one event loop and rate limiter"""
+        self._queue = asyncio.Queue()
+        self._queued_ids = set()
+        self._loop = asyncio.get_running_loop()
+        if self.shard_id == 0:
+            # Shard 0 migrates tickets that predate sharding so every worker can see them
+            self.backfill_unsharded_tickets()
+        self.recover_abandoned_claims()
+        watch = self.pending_query.on_snapshot(self.on_pending_tickets)
 
-                # Rate limiting - wait between API calls
-                time.sleep(2)
+        try:
+            while self.running:
+                tickets = await self.next_tickets_batch()
+                if not tickets:
+                    continue
 
-            except Exception as e:
-                self.logger.error(f"Error processing ticket {ticket.get('id', 'unknown')}: {e}")
                 try:
-                    self.update_ticket_status(ticket['id'], 'error')
-                except:
-                    pass
-                error_count += 1
+                    tickets = self.claim_tickets(tickets)
+                    if tickets:
+                        await self.process_tickets_batch(tickets)
+                except Exception as e:
+                    self.logger.error(f"Unexpected error in processing loop: {e}")
+                    await asyncio.sleep(60)  # Wait 1 minute before retrying
+                    # The listener won't announce these again; claimed ones keep their claim
+                    for ticket in tickets:
+                        self._queue.put_nowait(ticket)
+                    continue
 
-        self.logger.info(f"Batch processing complete: {processed_count} processed, {error_count} errors")
+                for ticket in tickets:
+                    self._queued_ids.discard(ticket['id'])
+        finally:
+            watch.unsubscribe()
+            await self._hx.aclose()
 
     def run_continuous(self):
         """Run the processing agent continuously"""
         self.logger.info(f"Starting sentiment processing agent for app: {self.app_id}")
-        self.logger.info(f"Processing interval: {self.processing_interval} seconds")
         self.logger.info(f"Batch size: {self.batch_size}")
+        self.logger.info(f"Gemini limits: {self.gemini_rpm} requests/minute, {self.gemini_concurrency} concurrent")
 
         def signal_handler(signum, frame):
             self.logger.info("Received shutdown signal")
-            self.running = False
+            self.stop()
 
         # Register signal handlers
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
 
-        while self.running:
-            try:
-                self.process_tickets_batch()
-
-                # Sleep with interruption check
-                for _ in range(self.processing_interval):
-                    if not self.running:
-                        break
-                    time.sleep(1)
-
-            except Exception as e:
-                self.logger.error(f"Unexpected error in processing loop: {e}")
-                time.sleep(60)  # Wait 1 minute before retrying
+        asyncio.run(self.process_continuously())
 
         self.logger.info("Sentiment processing agent stopped")
 